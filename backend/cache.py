@@ -0,0 +1,396 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Protocol, Sequence, Tuple
+
+import numpy as np
+
+
+class CacheBackend(Protocol):
+    """Key/value store shared by the engine's caches.
+
+    ``InMemoryBackend`` is used for a single process; ``RedisBackend`` lets
+    several workers share cached data (``shared`` is True).
+    """
+
+    shared: bool
+
+    def get(self, key: str) -> Optional[bytes]: ...
+    def set(self, key: str, value: bytes, ttl: Optional[int] = None) -> None: ...
+    def add(self, key: str, value: bytes, ttl: Optional[int] = None) -> bool: ...
+    def delete(self, key: str) -> None: ...
+    def delete_prefix(self, prefix: str) -> None: ...
+    def hset(self, name: str, field: str, value: bytes) -> None: ...
+    def hgetall(self, name: str) -> Dict[str, bytes]: ...
+    def hdel(self, name: str, *fields: str) -> None: ...
+
+
+class InMemoryBackend:
+    """Process-local CacheBackend built on dicts."""
+
+    shared = False
+    PURGE_INTERVAL = 60.0  # Seconds between sweeps for expired keys
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (value, expires_at or None)
+        self._values: Dict[str, Tuple[bytes, Optional[float]]] = {}
+        self._hashes: Dict[str, Dict[str, bytes]] = {}
+        self._last_purge = time.monotonic()
+
+    def _purge_expired(self, now: float):
+        """Drop expired keys that were never read again (caller holds the lock)."""
+        self._last_purge = now
+        for key in [k for k, (_, expires_at) in self._values.items() if expires_at is not None and now >= expires_at]:
+            del self._values[key]
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[int] = None) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._values[key] = (value, now + ttl if ttl else None)
+            if now - self._last_purge >= self.PURGE_INTERVAL:
+                self._purge_expired(now)
+
+    def add(self, key: str, value: bytes, ttl: Optional[int] = None) -> bool:
+        """Set key only if it's absent (or expired); returns whether it was set."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None and (entry[1] is None or now < entry[1]):
+                return False
+            self._values[key] = (value, now + ttl if ttl else None)
+            return True
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._values.pop(key, None)
+            self._hashes.pop(key, None)
+
+    def delete_prefix(self, prefix: str) -> None:
+        with self._lock:
+            for store in (self._values, self._hashes):
+                for key in [k for k in store if k.startswith(prefix)]:
+                    del store[key]
+
+    def hset(self, name: str, field: str, value: bytes) -> None:
+        with self._lock:
+            self._hashes.setdefault(name, {})[field] = value
+
+    def hgetall(self, name: str) -> Dict[str, bytes]:
+        with self._lock:
+            return dict(self._hashes.get(name, {}))
+
+    def hdel(self, name: str, *fields: str) -> None:
+        with self._lock:
+            fields_map = self._hashes.get(name, {})
+            for field in fields:
+                fields_map.pop(field, None)
+
+
+class RedisBackend:
+    """CacheBackend on Redis/Valkey so multiple workers share cache hits.
+
+    Uses the synchronous client: the caches are read from worker threads
+    (e.g. langchain's embed_query), not only from the event loop.
+    """
+
+    shared = True
+
+    def __init__(self, url: str):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.client.ping()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: Optional[int] = None) -> None:
+        self.client.set(key, value, ex=ttl)
+
+    def add(self, key: str, value: bytes, ttl: Optional[int] = None) -> bool:
+        # SET NX is atomic, so only one worker can win
+        return bool(self.client.set(key, value, ex=ttl, nx=True))
+
+    def delete(self, key: str) -> None:
+        self.client.delete(key)
+
+    def delete_prefix(self, prefix: str) -> None:
+        batch = []
+        for key in self.client.scan_iter(match=prefix + "*", count=1000):
+            batch.append(key)
+            if len(batch) >= 1000:
+                self.client.delete(*batch)
+                batch = []
+        if batch:
+            self.client.delete(*batch)
+
+    def hset(self, name: str, field: str, value: bytes) -> None:
+        self.client.hset(name, field, value)
+
+    def hgetall(self, name: str) -> Dict[str, bytes]:
+        return {k.decode() if isinstance(k, bytes) else k: v for k, v in self.client.hgetall(name).items()}
+
+    def hdel(self, name: str, *fields: str) -> None:
+        if fields:
+            self.client.hdel(name, *fields)
+
+
+def get_cache_backend() -> CacheBackend:
+    """Redis when REDIS_URL is set (and reachable), otherwise an in-process backend."""
+    url = os.getenv("REDIS_URL")
+    if url:
+        try:
+            backend = RedisBackend(url)
+            print(f"Using shared Redis cache at {url}")
+            return backend
+        except Exception as e:
+            print(f"WARNING: Could not connect to Redis at {url} ({e}). Using in-process caches.")
+    return InMemoryBackend()
+
+
+class SemanticCache:
+    """In-memory answer cache keyed by question embedding similarity.
+
+    Near-duplicate questions (cosine similarity >= threshold) asked against the
+    same book filter reuse the stored (answer, sources) instead of re-running
+    retrieval and the LLM call.
+
+    With a shared ``backend`` (e.g. Redis), entries are also written to a single
+    hash and the local similarity matrix is rebuilt from it every
+    ``sync_interval`` seconds, so answers cached by one worker serve the others.
+    """
+
+    HASH_NAME = "rag:answers"
+
+    def __init__(
+        self,
+        dim: int = 384,  # all-MiniLM-L6-v2 embedding size
+        threshold: float = 0.95,
+        max_size: int = 500,
+        ttl_seconds: Optional[float] = None,
+        backend: Optional[CacheBackend] = None,
+        sync_interval: float = 2.0,
+    ):
+        self.dim = dim
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend
+        self.sync_interval = sync_interval
+        self._last_sync = 0.0
+        self._lock = threading.RLock()
+        self._next_id = 0
+        # entry id -> (filter_key, answer, sources), ordered from least to most recently used
+        self._entries: "OrderedDict[int, Tuple[Optional[str], str, List[str]]]" = OrderedDict()
+        # Row i of the matrix belongs to _row_ids[i]
+        self._matrix = np.empty((0, dim), dtype=np.float32)
+        self._row_ids = np.empty(0, dtype=np.int64)
+        self._timestamps = np.empty(0, dtype=np.float64)
+        self._filters: List[Optional[str]] = []
+
+    def _normalize(self, vector: Sequence[float]) -> np.ndarray:
+        vec = np.asarray(vector, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _remove_rows(self, rows: np.ndarray):
+        if len(rows) == 0:
+            return
+        for entry_id in self._row_ids[rows]:
+            self._entries.pop(int(entry_id), None)
+        keep = np.ones(len(self._row_ids), dtype=bool)
+        keep[rows] = False
+        self._matrix = self._matrix[keep]
+        self._row_ids = self._row_ids[keep]
+        self._timestamps = self._timestamps[keep]
+        self._filters = [f for f, k in zip(self._filters, keep) if k]
+
+    def _expire(self):
+        if self.ttl_seconds is None or len(self._timestamps) == 0:
+            return
+        expired = np.nonzero(time.time() - self._timestamps > self.ttl_seconds)[0]
+        self._remove_rows(expired)
+
+    def _pack(self, vector: np.ndarray, answer: str, sources: List[str], filter_key: Optional[str], stored_at: float) -> bytes:
+        import msgpack
+
+        return msgpack.packb((vector.astype(np.float32).tobytes(), filter_key, answer, list(sources), stored_at))
+
+    def _sync(self, force: bool = False):
+        """Rebuild the local index from the shared backend (caller holds the lock)."""
+        if self.backend is None or (not force and time.monotonic() - self._last_sync < self.sync_interval):
+            return
+        import msgpack
+
+        self._last_sync = time.monotonic()
+        try:
+            raw = self.backend.hgetall(self.HASH_NAME)
+        except Exception as e:
+            print(f"Answer cache sync failed: {e}")
+            return
+        entries, corrupt = [], []
+        for field, value in raw.items():
+            try:
+                vec_bytes, filter_key, answer, sources, stored_at = msgpack.unpackb(value)
+                vec = np.frombuffer(vec_bytes, dtype=np.float32)
+                if vec.shape != (self.dim,):
+                    raise ValueError(f"expected {self.dim} dims, got {vec.shape}")
+            except Exception as e:
+                # One bad value shouldn't take down every lookup; drop it instead
+                print(f"Dropping unreadable answer cache entry {field}: {e}")
+                corrupt.append(field)
+                continue
+            entries.append((stored_at, field, vec, filter_key, answer, sources))
+        entries.sort(key=lambda e: e[0])
+        now = time.time()
+        stale, fresh = [], []
+        for entry in entries:
+            expired = self.ttl_seconds is not None and now - entry[0] > self.ttl_seconds
+            (stale if expired else fresh).append(entry)
+        # Oldest entries beyond max_size are evicted for every worker
+        overflow = len(fresh) - self.max_size
+        if overflow > 0:
+            stale += fresh[:overflow]
+            fresh = fresh[overflow:]
+        if stale or corrupt:
+            try:
+                self.backend.hdel(self.HASH_NAME, *[entry[1] for entry in stale], *corrupt)
+            except Exception as e:
+                print(f"Answer cache eviction failed: {e}")
+
+        self._entries.clear()
+        self._next_id = 0
+        rows, row_ids, timestamps, filters = [], [], [], []
+        for stored_at, _, vec, filter_key, answer, sources in fresh:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (filter_key, answer, list(sources))
+            rows.append(vec)
+            row_ids.append(entry_id)
+            timestamps.append(stored_at)
+            filters.append(filter_key)
+        self._matrix = np.vstack(rows) if rows else np.empty((0, self.dim), dtype=np.float32)
+        self._row_ids = np.asarray(row_ids, dtype=np.int64)
+        self._timestamps = np.asarray(timestamps, dtype=np.float64)
+        self._filters = filters
+
+    def lookup(self, vector: Sequence[float], filter_key: Optional[str] = None) -> Optional[Tuple[str, List[str]]]:
+        """Return the cached (answer, sources) for a similar question, if any."""
+        q = self._normalize(vector)
+        with self._lock:
+            self._sync()
+            self._expire()
+            if len(self._row_ids) == 0:
+                return None
+            sims = self._matrix @ q
+            # Only entries for the same book filter are candidates
+            mask = np.fromiter((f == filter_key for f in self._filters), dtype=bool, count=len(self._filters))
+            sims = np.where(mask, sims, -np.inf)
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            entry_id = int(self._row_ids[best])
+            self._entries.move_to_end(entry_id)
+            _, answer, sources = self._entries[entry_id]
+            return answer, list(sources)
+
+    def add(self, vector: Sequence[float], answer: str, sources: List[str], filter_key: Optional[str] = None):
+        """Store an answer, evicting the least recently used entries beyond max_size."""
+        q = self._normalize(vector)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (filter_key, answer, list(sources))
+            self._matrix = np.vstack([self._matrix, q[np.newaxis, :]])
+            self._row_ids = np.append(self._row_ids, entry_id)
+            stored_at = time.time()
+            self._timestamps = np.append(self._timestamps, stored_at)
+            self._filters.append(filter_key)
+            if self.backend is not None:
+                try:
+                    field = f"{os.getpid()}:{entry_id}:{stored_at}"
+                    self.backend.hset(self.HASH_NAME, field, self._pack(q, answer, sources, filter_key, stored_at))
+                except Exception as e:
+                    print(f"Answer cache write failed: {e}")
+
+            overflow = len(self._entries) - self.max_size
+            if overflow > 0:
+                lru_ids = list(self._entries.keys())[:overflow]
+                self._remove_rows(np.nonzero(np.isin(self._row_ids, lru_ids))[0])
+
+    def clear(self):
+        with self._lock:
+            if self.backend is not None:
+                try:
+                    self.backend.delete(self.HASH_NAME)
+                except Exception as e:
+                    print(f"Answer cache clear failed: {e}")
+            self._entries.clear()
+            self._matrix = np.empty((0, self.dim), dtype=np.float32)
+            self._row_ids = np.empty(0, dtype=np.int64)
+            self._timestamps = np.empty(0, dtype=np.float64)
+            self._filters = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class PrefetchCache:
+    """Short-lived store of documents retrieved speculatively while the user types.
+
+    One entry is kept per (session, book filter); a newer partial message replaces
+    the older one. A final question can reuse the documents when the partial text
+    is a prefix covering most of it.
+    """
+
+    def __init__(self, ttl_seconds: float = 10.0, min_coverage: float = 0.6, max_size: int = 1000):
+        self.ttl_seconds = ttl_seconds
+        self.min_coverage = min_coverage
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # (session_id, filter_key) -> (partial, documents, stored_at)
+        self._entries: "OrderedDict[Tuple[str, Optional[str]], Tuple[str, List[Any], float]]" = OrderedDict()
+
+    def _normalize(self, text: str) -> str:
+        return " ".join(text.lower().split())
+
+    def put(self, session_id: str, partial: str, documents: List[Any], filter_key: Optional[str] = None):
+        now = time.monotonic()
+        with self._lock:
+            key = (session_id, filter_key)
+            self._entries.pop(key, None)
+            self._entries[key] = (self._normalize(partial), documents, now)
+            # Entries are in insertion order, so expired ones are at the front
+            while self._entries:
+                oldest_key, (_, _, stored_at) = next(iter(self._entries.items()))
+                if now - stored_at <= self.ttl_seconds and len(self._entries) <= self.max_size:
+                    break
+                self._entries.pop(oldest_key)
+
+    def match(self, session_id: str, question: str, filter_key: Optional[str] = None) -> Optional[List[Any]]:
+        """Return prefetched documents if they were retrieved for a prefix of this question."""
+        with self._lock:
+            entry = self._entries.get((session_id, filter_key))
+            if entry is None:
+                return None
+            partial, documents, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                self._entries.pop((session_id, filter_key), None)
+                return None
+        final = self._normalize(question)
+        if not partial or not final.startswith(partial) or len(partial) < self.min_coverage * len(final):
+            return None
+        return documents
@@ -0,0 +1,354 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import platform
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+MINILM_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+class SQLiteEmbeddingStore:
+    """On-disk text -> embedding cache so query embeddings survive restarts.
+
+    Keys are truncated SHA-256 hashes of the text (prefixed with ``namespace`` so
+    vectors from different models never mix); values are raw float32 bytes.
+    Beyond ``max_rows`` entries the oldest ones are deleted.
+    """
+
+    PRUNE_EVERY = 100  # Writes between checks against max_rows
+
+    def __init__(self, path: str = "embedding_cache.db", namespace: str = "", max_rows: int = 50_000):
+        self.path = path
+        self.namespace = namespace
+        self.max_rows = max_rows
+        self._writes_since_prune = 0
+        # sqlite3 connections can't be shared across threads, so keep one per thread.
+        # They're opened on first use, never here: the store may be created before
+        # workers are forked, and a connection must not cross fork()
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        # A forked child inherits its parent's thread-locals; open a fresh connection there
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS emb_cache "
+                "(text_hash BLOB PRIMARY KEY, vec BLOB, created_at REAL) WITHOUT ROWID"
+            )
+            # Caches written before entries were timestamped count as the oldest
+            if "created_at" not in {row[1] for row in conn.execute("PRAGMA table_info(emb_cache)")}:
+                conn.execute("ALTER TABLE emb_cache ADD COLUMN created_at REAL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS emb_cache_created_at ON emb_cache (created_at)")
+            conn.commit()
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.sha256((self.namespace + "\0" + text).encode("utf-8")).digest()[:16]
+
+    def get(self, text: str) -> Optional[List[float]]:
+        try:
+            row = self._connection().execute(
+                "SELECT vec FROM emb_cache WHERE text_hash = ?", (self._key(text),)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Embedding cache read failed: {e}")
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).tolist() if row else None
+
+    def put(self, text: str, vector) -> None:
+        try:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR IGNORE INTO emb_cache (text_hash, vec, created_at) VALUES (?, ?, ?)",
+                (self._key(text), np.asarray(vector, dtype=np.float32).tobytes(), time.time()),
+            )
+            self._writes_since_prune += 1
+            if self._writes_since_prune >= self.PRUNE_EVERY:
+                self._writes_since_prune = 0
+                self._prune(conn)
+            conn.commit()
+        except sqlite3.Error as e:
+            # The cache is an optimization; never fail an embedding because of it
+            print(f"Embedding cache write failed: {e}")
+
+    def _prune(self, conn: sqlite3.Connection):
+        """Delete the oldest entries beyond max_rows."""
+        (count,) = conn.execute("SELECT COUNT(*) FROM emb_cache").fetchone()
+        if count > self.max_rows:
+            conn.execute(
+                "DELETE FROM emb_cache WHERE text_hash IN "
+                "(SELECT text_hash FROM emb_cache ORDER BY created_at LIMIT ?)",
+                (count - self.max_rows,),
+            )
+
+    def clear(self) -> None:
+        conn = self._connection()
+        conn.execute("DELETE FROM emb_cache")
+        conn.commit()
+
+
+class BackendEmbeddingStore:
+    """Embedding store on a CacheBackend (e.g. Redis), shared by all workers.
+
+    Same interface as SQLiteEmbeddingStore.
+    """
+
+    PREFIX = "rag:emb:"
+
+    def __init__(self, backend, namespace: str = "", ttl: Optional[int] = None):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.sha256((self.namespace + "\0" + text).encode("utf-8")).hexdigest()[:32]
+        return f"{self.PREFIX}{self.namespace}:{digest}"
+
+    def get(self, text: str) -> Optional[List[float]]:
+        try:
+            value = self.backend.get(self._key(text))
+        except Exception as e:
+            print(f"Embedding cache read failed: {e}")
+            return None
+        return np.frombuffer(value, dtype=np.float32).tolist() if value else None
+
+    def put(self, text: str, vector) -> None:
+        try:
+            self.backend.set(self._key(text), np.asarray(vector, dtype=np.float32).tobytes(), ttl=self.ttl)
+        except Exception as e:
+            print(f"Embedding cache write failed: {e}")
+
+    def clear(self) -> None:
+        self.backend.delete_prefix(f"{self.PREFIX}{self.namespace}:")
+
+
+class CachedEmbeddings(Embeddings):
+    """Memoizes an embeddings model so repeated texts skip the forward pass.
+
+    Query embeddings are kept in an in-process LRU and, if ``store`` is given
+    (SQLiteEmbeddingStore or BackendEmbeddingStore), persisted so they survive
+    restarts.
+    """
+
+    def __init__(self, base: Embeddings, maxsize: int = 2048, documents_maxsize: int = 32, store=None):
+        self.base = base
+        self.store = store
+        self._embed_query = lru_cache(maxsize=maxsize)(self._embed_query_uncached)
+        # Document batches can be whole books, so keep far fewer of them around
+        self._embed_documents = lru_cache(maxsize=documents_maxsize)(self._embed_documents_uncached)
+
+    def _embed_query_uncached(self, text: str) -> Tuple[float, ...]:
+        vector = self.store.get(text) if self.store else None
+        if vector is None:
+            vector = self.base.embed_query(text)
+            if self.store:
+                self.store.put(text, vector)
+        return tuple(vector)
+
+    def _embed_documents_uncached(self, texts: Tuple[str, ...]) -> Tuple[Tuple[float, ...], ...]:
+        return tuple(tuple(v) for v in self.base.embed_documents(list(texts)))
+
+    def embed_query(self, text: str) -> List[float]:
+        # Cached values are stored as tuples so callers can't mutate them
+        return list(self._embed_query(text))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [list(v) for v in self._embed_documents(tuple(texts))]
+
+    def cache_clear(self):
+        """Drop all memoized embeddings, including the persisted ones."""
+        self._embed_query.cache_clear()
+        self._embed_documents.cache_clear()
+        if self.store:
+            self.store.clear()
+
+    def cache_info(self) -> dict:
+        return {
+            "query": self._embed_query.cache_info()._asdict(),
+            "documents": self._embed_documents.cache_info()._asdict(),
+        }
+
+
+def _cpu_has_flag(flag: str) -> bool:
+    """Whether /proc/cpuinfo lists ``flag`` (always False where it doesn't exist, e.g. macOS)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            return any(line.startswith("flags") and flag in line.split() for line in f)
+    except OSError:
+        return False
+
+
+def _quantization_target() -> str:
+    """AutoQuantizationConfig preset matching this CPU: arm64, avx512_vnni or avx2."""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"  # e.g. Apple Silicon
+    return "avx512_vnni" if _cpu_has_flag("avx512_vnni") else "avx2"
+
+
+class QuantizedMiniLMEmbeddings(Embeddings):
+    """all-MiniLM-L6-v2 exported to ONNX with int8 dynamic quantization.
+
+    The quantized model is exported once per CPU target (see _quantization_target)
+    and reused from ``cache_dir``. Only the encoder weights are int8; pooled
+    output vectors stay FP32.
+    """
+
+    def __init__(self, model_name: str = MINILM_MODEL_NAME, cache_dir: str = "onnx_models", max_length: int = 256):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        self.max_length = max_length
+        target = _quantization_target()
+        save_dir = os.path.join(cache_dir, f"{model_name.replace('/', '__')}-int8-{target}")
+        quantized_file = "model_quantized.onnx"
+
+        if not os.path.exists(os.path.join(save_dir, quantized_file)):
+            print(f"Exporting {model_name} to ONNX and quantizing to int8 for {target} (first run only)...")
+            fp32_model = ORTModelForFeatureExtraction.from_pretrained(
+                model_name, export=True, provider="CPUExecutionProvider"
+            )
+            quantizer = ORTQuantizer.from_pretrained(fp32_model)
+            qconfig = getattr(AutoQuantizationConfig, target)(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=save_dir, quantization_config=qconfig)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(save_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(save_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            save_dir, file_name=quantized_file, provider="CPUExecutionProvider"
+        )
+
+    def encode(
+        self,
+        texts: List[str],
+        batch_size: int = 64,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = True,
+        show_progress_bar: bool = False,
+    ) -> np.ndarray:
+        """Mean-pooled sentence embeddings, mirroring SentenceTransformer.encode."""
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np",
+            )
+            token_embeddings = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"][..., np.newaxis].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled.astype(np.float32))
+        if not batches:
+            return np.empty((0, 384), dtype=np.float32)
+        return np.vstack(batches)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+
+class AsyncBatcher:
+    """Coalesces embedding requests that arrive close together into one encode() call.
+
+    Requests are collected for up to ``max_wait`` seconds (or until ``max_batch``
+    are queued) and encoded together in a worker thread, trading a few
+    milliseconds of latency for far fewer forward passes under concurrent load.
+    """
+
+    def __init__(self, encode: Callable[[List[str]], np.ndarray], max_batch: int = 16, max_wait: float = 0.005):
+        self.encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            # (Re)start on the current loop, e.g. after a reload or in a fresh asyncio.run()
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def embed(self, text: str) -> List[float]:
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            items = [await self._queue.get()]
+            await asyncio.sleep(self.max_wait)
+            while len(items) < self.max_batch and not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            try:
+                vectors = await asyncio.to_thread(self.encode, [text for text, _ in items])
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), vector in zip(items, vectors):
+                if not future.done():
+                    future.set_result(np.asarray(vector).tolist())
+
+
+def load_embeddings():
+    """Return (embeddings, encoder) for MiniLM, preferring the int8 ONNX model.
+
+    ``encoder`` exposes a SentenceTransformer-style ``encode`` for batch ingestion.
+    Falls back to the FP32 HuggingFace model if optimum/onnxruntime aren't installed
+    or the ONNX export/quantization fails.
+    """
+    try:
+        quantized = QuantizedMiniLMEmbeddings()
+        return quantized, quantized
+    except ImportError as e:
+        print(f"WARNING: Quantized embeddings unavailable ({e}). Falling back to FP32 model.")
+    except Exception as e:
+        # e.g. a failed model download or an optimum API change; FP32 still works
+        print(f"WARNING: Could not load int8 ONNX embeddings ({type(e).__name__}: {e}). Falling back to FP32 model.")
+
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    embeddings = HuggingFaceEmbeddings(
+        model_name=MINILM_MODEL_NAME,
+        model_kwargs={'device': 'cpu'},  # Use CPU (no GPU needed)
+        encode_kwargs={'normalize_embeddings': True}
+    )
+    return embeddings, embeddings.client
+
+
+def prepare_embeddings():
+    """Download the model and build the int8 ONNX export on disk, without loading it here.
+
+    The work runs in a spawned child process, so the caller (e.g. a gunicorn master
+    before it forks workers) never creates ONNX Runtime sessions or torch thread
+    pools, neither of which survive fork(). Workers then only load the files.
+    """
+    process = multiprocessing.get_context("spawn").Process(target=load_embeddings)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        print(f"WARNING: Preparing the embeddings model failed (exit code {process.exitcode}); workers will load it themselves.")
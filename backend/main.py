@@ -1,19 +1,46 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, Response
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional, Tuple
+import aiofiles
+import asyncio
+import json
 import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
 from urllib.parse import unquote
 from dotenv import load_dotenv
 from storage import LocalStorageProvider
-from rag_engine import rag_engine
+from embeddings import prepare_embeddings
+from rag_engine import RAGEngine, get_rag_engine
 
 # Load environment variables
 load_dotenv()
 
+# With `gunicorn --preload`, RAG_PRELOAD=1 downloads the model and builds the
+# int8 ONNX export once before workers are forked, instead of every worker racing
+# to write the same files. Nothing is loaded into the master itself: model
+# sessions, thread pools and database connections don't survive fork(), so each
+# worker builds its own engine at startup
+if os.getenv("RAG_PRELOAD") == "1":
+    prepare_embeddings()
+
 app = FastAPI(title="Book Study Platform API")
 
+@app.on_event("startup")
+def load_rag_engine():
+    # Deferred to startup so importing this module (e.g. on reload) stays cheap
+    app.state.rag_engine = get_rag_engine()
+    # Pay model and index cold-start costs now rather than in the first /chat
+    try:
+        app.state.rag_engine.warm_up()
+    except Exception as e:
+        print(f"WARNING: Warm-up failed: {e}")
+
+def get_engine(request: Request) -> RAGEngine:
+    return request.app.state.rag_engine
+
 # Allow CORS
 app.add_middleware(
     CORSMiddleware,
@@ -28,6 +55,77 @@ app.add_middleware(
 LIBRARY_PATH = "/Users/ayush/Desktop/self/MAPY-first year"
 storage = LocalStorageProvider(base_dir=LIBRARY_PATH)
 
+# Ingestion jobs ({"state": "pending|running|done|error", ...}) live in the engine's
+# cache backend, so with REDIS_URL set any worker can answer GET /ingest/{job_id}.
+# Keys expire, so finished jobs don't pile up.
+INGEST_JOB_TTL = 24 * 3600       # Seconds a pending/running job is kept
+FINISHED_JOB_TTL = 3600          # Seconds a done/failed job stays pollable
+
+def _job_key(job_id: str) -> str:
+    return f"rag:ingest_job:{job_id}"
+
+def _get_job(rag_engine: RAGEngine, job_id: str) -> Optional[dict]:
+    raw = rag_engine.shared_cache.get(_job_key(job_id))
+    return json.loads(raw) if raw else None
+
+def _save_job(rag_engine: RAGEngine, job_id: str, job: dict):
+    ttl = FINISHED_JOB_TTL if job["state"] in ("done", "error") else INGEST_JOB_TTL
+    rag_engine.shared_cache.set(_job_key(job_id), json.dumps(job).encode(), ttl=ttl)
+
+def _set_job(rag_engine: RAGEngine, job_id: str, **fields):
+    # Only the background task updates a job after it's created, so no locking is needed
+    job = _get_job(rag_engine, job_id) or {}
+    job.update(fields)
+    _save_job(rag_engine, job_id, job)
+
+def _active_job_key(filename: str) -> str:
+    return f"rag:ingest_active:{filename}"
+
+def _claim_active_job(rag_engine: RAGEngine, filename: str, job_id: str) -> Optional[str]:
+    """Make job_id the file's active ingestion job.
+
+    Returns the id of a pending/running job for the same file instead, so repeated
+    requests (re-selecting a book, clicking "Memorize Book" during auto-ingest)
+    poll that job rather than starting a second ingestion.
+    """
+    backend = rag_engine.shared_cache
+    key = _active_job_key(filename)
+    if backend.add(key, job_id.encode(), ttl=INGEST_JOB_TTL):
+        return None
+    active_id = backend.get(key)
+    active = _get_job(rag_engine, active_id.decode()) if active_id else None
+    if active and active["state"] in ("pending", "running"):
+        return active_id.decode()
+    # Left behind by a job that finished or expired
+    backend.set(key, job_id.encode(), ttl=INGEST_JOB_TTL)
+    return None
+
+def _release_active_job(rag_engine: RAGEngine, filename: str, job_id: str):
+    active_id = rag_engine.shared_cache.get(_active_job_key(filename))
+    if active_id and active_id.decode() == job_id:
+        rag_engine.shared_cache.delete(_active_job_key(filename))
+
+async def _run_ingestion(rag_engine: RAGEngine, job_id: str, filename: str, full_path: str):
+    """Background task that ingests a file and records the outcome on the job."""
+    await asyncio.to_thread(_set_job, rag_engine, job_id, state="running")
+    try:
+        print(f"Starting ingestion of: {full_path}")
+        result = await rag_engine.ingest_file_async(full_path) or {}
+        if result.get("status") == "already_running":
+            # Same content and name being ingested by another job (e.g. from another folder)
+            raise RuntimeError("This book is already being ingested. Try again once that finishes.")
+        if result.get("status") == "already_ingested":
+            print(f"Skipped, already ingested: {full_path}")
+        else:
+            print(f"Successfully ingested: {full_path}")
+        await asyncio.to_thread(_set_job, rag_engine, job_id, state="done", result=result.get("status", "ingested"))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        await asyncio.to_thread(_set_job, rag_engine, job_id, state="error", error=str(e))
+    finally:
+        await asyncio.to_thread(_release_active_job, rag_engine, filename, job_id)
+
 class BookResponse(BaseModel):
     filename: str
     path: str
@@ -36,6 +134,12 @@ class ChatRequest(BaseModel):
     message: str
     book_context: str = None  # Optional: specific book to filter by
     chat_history: List[dict] = []  # Optional: conversation history
+    session_id: Optional[str] = None  # Optional: matches /chat/prefetch calls from the same client
+
+class PrefetchRequest(BaseModel):
+    partial_message: str
+    session_id: str
+    book_context: Optional[str] = None
 
 class ChatResponse(BaseModel):
     reply: str
@@ -46,7 +150,7 @@ def health_check():
     return {"status": "ok", "library": LIBRARY_PATH}
 
 @app.get("/health/rag")
-def rag_health_check():
+def rag_health_check(rag_engine: RAGEngine = Depends(get_engine)):
     """Check if RAG engine is properly configured."""
     try:
         # Check API key
@@ -64,12 +168,20 @@ def rag_health_check():
             "api_key_set": api_key_set,
             "api_provider": "Groq (free tier)",
             "llm_model": "llama-3.1-8b-instant",
-            "embeddings": "HuggingFace (free, local)",
-            "documents_in_store": doc_count
+            "embeddings": f"{rag_engine.embedding_model_tag} (free, local)",
+            "documents_in_store": doc_count,
+            "cache_backend": "redis" if rag_engine.shared_cache.shared else "in-process",
+            "llm_requests_remaining_this_minute": rag_engine.llm_quota_remaining()
         }
     except Exception as e:
         return {"status": "error", "error": str(e)}
 
+@app.post("/admin/clear-cache")
+def clear_cache(rag_engine: RAGEngine = Depends(get_engine)):
+    """Clear the embedding and answer caches (e.g. after re-ingesting books)."""
+    rag_engine.clear_caches()
+    return {"status": "cleared"}
+
 @app.get("/books", response_model=List[BookResponse])
 def list_books():
     """List all available PDFs in the MAPY library."""
@@ -80,9 +192,9 @@ def list_books():
         # Fallback if path is wrong
         raise HTTPException(status_code=500, detail=f"Error accessing library at {LIBRARY_PATH}: {str(e)}")
 
-@app.post("/ingest")
-def ingest_book(filename: str):
-    """Trigger manual ingestion of a book."""
+@app.post("/ingest", status_code=202)
+async def ingest_book(filename: str, background_tasks: BackgroundTasks, rag_engine: RAGEngine = Depends(get_engine)):
+    """Queue ingestion of a book; poll GET /ingest/{job_id} for progress."""
     try:
         # URL decode the filename in case it's encoded
         decoded_filename = unquote(filename)
@@ -104,15 +216,26 @@ def ingest_book(filename: str):
                 detail="Only PDF files can be ingested."
             )
         
-        # Ingest the file
-        print(f"Starting ingestion of: {full_path}")
-        rag_engine.ingest_file(full_path)
-        print(f"Successfully ingested: {full_path}")
+        # Queue the ingestion so the request doesn't block while the PDF is embedded
+        job_id = uuid.uuid4().hex
+        job = {"state": "pending", "file": decoded_filename, "error": None}
+        await asyncio.to_thread(_save_job, rag_engine, job_id, job)
+        active_id = await asyncio.to_thread(_claim_active_job, rag_engine, decoded_filename, job_id)
+        if active_id:
+            await asyncio.to_thread(rag_engine.shared_cache.delete, _job_key(job_id))
+            return {
+                "status": "already_queued",
+                "job_id": active_id,
+                "file": decoded_filename,
+                "message": f"{os.path.basename(decoded_filename)} is already being ingested"
+            }
+        background_tasks.add_task(_run_ingestion, rag_engine, job_id, decoded_filename, full_path)
         
         return {
-            "status": "ingested", 
+            "status": "queued", 
+            "job_id": job_id,
             "file": decoded_filename,
-            "message": f"Successfully ingested {os.path.basename(decoded_filename)}"
+            "message": f"Queued {os.path.basename(decoded_filename)} for ingestion"
         }
     except HTTPException:
         raise
@@ -125,8 +248,16 @@ def ingest_book(filename: str):
             detail=f"Error ingesting file '{filename}': {error_detail}"
         )
 
+@app.get("/ingest/{job_id}")
+def ingest_status(job_id: str, rag_engine: RAGEngine = Depends(get_engine)):
+    """Get the state of a queued ingestion job."""
+    job = _get_job(rag_engine, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired ingestion job: {job_id}")
+    return {"job_id": job_id, **job}
+
 @app.post("/chat", response_model=ChatResponse)
-def chat(request: ChatRequest):
+async def chat(request: ChatRequest, rag_engine: RAGEngine = Depends(get_engine)):
     """Ask a question to the RAG system."""
     try:
         # Validate request
@@ -135,10 +266,11 @@ def chat(request: ChatRequest):
         
         # If book_context is provided, we could filter, but for now we search all
         # Pass chat history for conversational context
-        answer, sources = rag_engine.query(
+        answer, sources = await rag_engine.aquery(
             request.message, 
             filter_filename=request.book_context,
-            chat_history=request.chat_history
+            chat_history=request.chat_history,
+            session_id=request.session_id
         )
         return {"reply": answer, "sources": sources}
     except HTTPException:
@@ -149,9 +281,92 @@ def chat(request: ChatRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error processing chat request: {error_detail}")
 
+@app.post("/chat/prefetch")
+async def chat_prefetch(request: PrefetchRequest, rag_engine: RAGEngine = Depends(get_engine)):
+    """Speculatively retrieve documents for a message the user is still typing.
+
+    Only used by /chat when it retrieves on the raw question, i.e. first questions
+    and follow-ups that don't need rewriting.
+    """
+    try:
+        count = await rag_engine.aprefetch(
+            request.partial_message,
+            session_id=request.session_id,
+            filter_filename=request.book_context
+        )
+        return {"status": "ok", "documents": count}
+    except Exception as e:
+        # Prefetching is best-effort; the real /chat call will retrieve normally
+        print(f"Prefetch error: {e}")
+        return {"status": "error", "documents": 0}
+
+PDF_STREAM_CHUNK_SIZE = 64 * 1024
+
+def _parse_range(range_header: Optional[str], file_size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single `bytes=` Range header into inclusive (start, end) offsets.
+
+    Returns None when there is no usable range (absent, malformed, multi-range or
+    last < first, which RFC 9110 says to ignore), in which case the whole file is
+    served. Raises 416 when the range starts past the end of the file.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_str, _, end_str = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else max(start, file_size - 1)
+        else:
+            # Suffix range: the last N bytes
+            suffix = int(end_str)
+            if suffix == 0:
+                raise ValueError("empty suffix range")
+            start, end = max(file_size - suffix, 0), file_size - 1
+    except ValueError:
+        return None
+    if start > end:
+        return None
+    if start >= file_size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    return start, min(end, file_size - 1)
+
+def _file_validators(stat: os.stat_result) -> Tuple[str, str]:
+    """Strong ETag and Last-Modified value for a file, derived from its mtime and size."""
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"', formatdate(stat.st_mtime, usegmt=True)
+
+def _not_modified(request: Request, etag: str, stat: os.stat_result) -> bool:
+    """Whether the client's cached copy is current (If-None-Match, else If-Modified-Since)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # Weak comparison, as RFC 9110 specifies for If-None-Match
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+async def _iter_file(path: str, start: int, length: int):
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await f.read(min(PDF_STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
 @app.get("/files/{file_path:path}")
-def get_file(file_path: str):
-    """Serve a PDF file securely."""
+async def get_file(file_path: str, request: Request):
+    """Serve a PDF file securely, honoring Range requests so viewers can fetch only what they render."""
     try:
         # URL decode the file path
         decoded_path = unquote(file_path)
@@ -173,13 +388,42 @@ def get_file(file_path: str):
                 detail="Only PDF files can be served"
             )
         
-        # Return the file with proper headers for inline display (not download)
-        return FileResponse(
-            full_path,
+        # Proper headers for inline display (not download), plus range/caching support.
+        # The validators let browsers revalidate with a 304 once max-age runs out,
+        # and keep them from mixing cached ranges of an older version of the file
+        stat = os.stat(full_path)
+        file_size = stat.st_size
+        etag, last_modified = _file_validators(stat)
+        headers = {
+            "Content-Disposition": f'inline; filename="{os.path.basename(decoded_path)}"',
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "public, max-age=3600",
+            "ETag": etag,
+            "Last-Modified": last_modified,
+        }
+        if _not_modified(request, etag, stat):
+            return Response(status_code=304, headers={k: v for k, v in headers.items() if k != "Content-Disposition"})
+
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if if_range and if_range.strip() not in (etag, last_modified):
+            # The client's partial copy is of another version: send the whole file
+            range_header = None
+        byte_range = _parse_range(range_header, file_size)
+        if byte_range is None:
+            start, end, status_code = 0, file_size - 1, 200
+        else:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        length = end - start + 1 if file_size else 0
+        headers["Content-Length"] = str(length)
+        
+        return StreamingResponse(
+            _iter_file(full_path, start, length),
+            status_code=status_code,
             media_type="application/pdf",
-            headers={
-                "Content-Disposition": f'inline; filename="{os.path.basename(decoded_path)}"'
-            }
+            headers=headers
         )
     except HTTPException:
         raise
@@ -1,15 +1,117 @@
-
+import asyncio
+import hashlib
 import os
-from typing import List, Tuple, Optional
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import closing
+from typing import Iterator, List, Tuple, Optional
 from langchain_community.document_loaders import PyPDFLoader
 # Using Groq for LLM (free tier) and HuggingFace for embeddings (free, no API key needed)
 from langchain_groq import ChatGroq
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_classic.chains import ConversationalRetrievalChain
+from langchain_classic.chains.conversational_retrieval.base import _get_chat_history
+from langchain_core.documents import Document
 from langchain_core.prompts import PromptTemplate
+from aiolimiter import AsyncLimiter
+from groq import APIConnectionError, InternalServerError, RateLimitError
+from tenacity import AsyncRetrying, Retrying, retry_if_exception_type, stop_after_attempt, wait_exponential
 import shutil
+from cache import PrefetchCache, SemanticCache, get_cache_backend
+from embeddings import AsyncBatcher, BackendEmbeddingStore, CachedEmbeddings, QuantizedMiniLMEmbeddings, SQLiteEmbeddingStore, load_embeddings
+
+# Tokenizer thread pools don't survive fork(); keep them off when workers are forked
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+# Ingestion pipeline tuning
+PAGE_QUEUE_SIZE = 32      # Parsed pages waiting to be split
+CHUNK_QUEUE_SIZE = 256    # Chunks waiting to be embedded
+INGEST_BATCH_SIZE = 64    # Chunks per vector store write
+ENCODE_BATCH_SIZE = 64    # Texts per embedding model forward pass
+
+# Completion records for ingested files, kept next to the vector store
+INGESTED_FILES_DB = "ingested_files.db"
+
+# Persisted query embeddings: row cap for the SQLite file, TTL (seconds) in Redis
+EMBEDDING_CACHE_MAX_ROWS = 50_000
+EMBEDDING_CACHE_TTL = 7 * 24 * 3600
+
+# How long (seconds) an ingestion holds its claim on a file; bounds how long a
+# crashed ingestion can block retries of the same file
+INGEST_CLAIM_TTL = 3600
+
+# Shared cache key for the vector store chunk count, and how long (seconds) it's
+# trusted; the TTL bounds a stale count set by a reader racing an ingestion
+DOC_COUNT_KEY = "rag:doc_count"
+DOC_COUNT_TTL = 30
+
+# Groq free tier allows 30 requests/minute; stay a little under it
+GROQ_REQUESTS_PER_MINUTE = 28
+_backoff_wait = wait_exponential(multiplier=1, min=2, max=20)
+
+def _groq_retry_wait(retry_state) -> float:
+    """Honor Groq's Retry-After header when sent, else back off exponentially."""
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), 60.0)
+    except (TypeError, ValueError):
+        return _backoff_wait(retry_state)
+
+# The SDK's own retries are disabled (max_retries=0) so 429s aren't retried twice;
+# this policy also covers what the SDK would otherwise retry: connection
+# errors and timeouts (APIConnectionError) and 5xx responses
+GROQ_RETRY_POLICY = dict(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+    wait=_groq_retry_wait,
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+# Follow-ups with at least this many words that don't start with one of these
+# pronouns are retrieved on directly instead of being rewritten by the LLM first
+STANDALONE_MIN_WORDS = 5
+FOLLOW_UP_PRONOUNS = {"it", "its", "that", "this", "these", "they", "them", "those", "he", "she"}
+
+# Prompt for study assistance
+# ConversationalRetrievalChain will provide chat_history as a variable
+STUDY_PROMPT_TEMPLATE = """You are an intelligent study assistant helping a student understand their course materials. 
+Your role is to:
+1. Understand the context of questions even if they're phrased informally (e.g., "this chapter", "this pdf", "summarize this")
+2. Provide comprehensive, helpful answers based on the retrieved documents
+3. Connect concepts and provide explanations, not just quote text
+4. If the question is vague, infer context from the conversation history and retrieved documents
+5. When asked to summarize, provide a clear, structured summary of the key points
+
+Use the following pieces of retrieved context to answer the question. If you don't know the answer based on the context, say so, but try to be helpful.
+
+Context from the documents:
+{context}
+
+Previous conversation:
+{chat_history}
+
+Question: {question}
+
+Provide a helpful, comprehensive answer:"""
+
+# QA chains kept for the most recently used book filters
+QA_CHAIN_CACHE_SIZE = 32
+
+# MMR retrieval settings, shared by the QA chains and prefetching
+RETRIEVER_SEARCH_KWARGS = {"k": 8, "fetch_k": 20}  # Retrieve more documents for better context
+
+# HNSW index settings, only applied when the collection is first created
+# (delete db_storage/ and re-ingest to rebuild an existing store with them)
+HNSW_COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
 
 class RAGEngine:
     def __init__(self, persist_directory: str = "db_storage"):
@@ -19,19 +121,36 @@ class RAGEngine:
             print("WARNING: GROQ_API_KEY not found. Please export it.")
             print("Get your free API key at: https://console.groq.com/")
 
-        # Use HuggingFace embeddings (free, no API key needed)
-        # Using a lightweight, fast model
+        # Use local MiniLM embeddings (free, no API key needed)
+        # int8-quantized ONNX model when available, FP32 HuggingFace model otherwise
         print("Loading embeddings model (this may take a moment on first run)...")
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            model_kwargs={'device': 'cpu'},  # Use CPU (no GPU needed)
-            encode_kwargs={'normalize_embeddings': True}
-        )
+        base_embeddings, self._st_model = load_embeddings()
+        # Redis when REDIS_URL is set so workers share cache hits, in-process otherwise
+        self.shared_cache = get_cache_backend()
+
+        # Memoize embeddings so repeated questions skip the transformer forward pass,
+        # persisting query vectors (to Redis or a local SQLite file) across restarts
+        # Which model actually loaded (int8 ONNX or the FP32 fallback), also shown by /health/rag
+        self.embedding_model_tag = "minilm-int8" if isinstance(base_embeddings, QuantizedMiniLMEmbeddings) else "minilm-fp32"
+        if self.shared_cache.shared:
+            self.embedding_store = BackendEmbeddingStore(
+                self.shared_cache, namespace=self.embedding_model_tag, ttl=EMBEDDING_CACHE_TTL
+            )
+        else:
+            self.embedding_store = SQLiteEmbeddingStore(
+                os.path.join(self.persist_directory, "embedding_cache.db"),
+                namespace=self.embedding_model_tag,
+                max_rows=EMBEDDING_CACHE_MAX_ROWS,
+            )
+        self.embeddings = CachedEmbeddings(base_embeddings, maxsize=2048, store=self.embedding_store)
+        # Concurrent async queries share one forward pass for their question embeddings
+        self.query_batcher = AsyncBatcher(self._encode_queries, max_batch=16, max_wait=0.005)
         print("Embeddings model loaded!")
         
         self.vector_store = Chroma(
             persist_directory=self.persist_directory,
-            embedding_function=self.embeddings
+            embedding_function=self.embeddings,
+            collection_metadata=HNSW_COLLECTION_METADATA
         )
         
         # Using Groq LLM (free tier)
@@ -40,187 +159,680 @@ class RAGEngine:
             groq_api_key=os.getenv("GROQ_API_KEY"),
             model_name="llama-3.1-8b-instant",  # Fast and free tier friendly
             temperature=0.3,
+            max_retries=0,  # Retries (429s, connection errors, 5xx) are handled by GROQ_RETRY_POLICY
         )
+        # Client-side limiter so bursts queue up instead of hitting Groq's 429s
+        self.llm_limiter = AsyncLimiter(max_rate=GROQ_REQUESTS_PER_MINUTE, time_period=60)
+        self._llm_call_times = deque()
+        self._llm_call_times_lock = threading.Lock()
         
         # Initialize conversation memory (will be created per query session)
         self.conversation_memories = {}  # Store memories per session
 
+        # Answer cache for near-duplicate questions (skips retrieval + LLM on a hit)
+        if self.shared_cache.shared:
+            self.answer_cache = SemanticCache(
+                dim=384, threshold=0.95, max_size=500, ttl_seconds=3600, backend=self.shared_cache
+            )
+        else:
+            self.answer_cache = SemanticCache(dim=384, threshold=0.95, max_size=500)
+        # Documents retrieved speculatively while the user is still typing
+        self.prefetch_cache = PrefetchCache(ttl_seconds=10.0)
+
+        # QA chains are built once (per book filter) and reused across queries
+        self._prompt = PromptTemplate(
+            template=STUDY_PROMPT_TEMPLATE,
+            input_variables=["context", "question", "chat_history"]
+        )
+        # filter -> chain, least recently used first; bounded since filters come from clients
+        self._qa_chains: "OrderedDict[Optional[str], ConversationalRetrievalChain]" = OrderedDict()
+        self._qa_chains_lock = threading.Lock()
+        self._qa_chains[None] = self._build_qa_chain(None)
+
+    def _build_qa_chain(self, filter_filename: Optional[str]) -> ConversationalRetrievalChain:
+        search_kwargs = dict(RETRIEVER_SEARCH_KWARGS)
+        if filter_filename:
+            # Passed to Chroma as a `where` clause so the filter is applied
+            # inside the HNSW search rather than on its results
+            search_kwargs["filter"] = {"source": filter_filename}
+
+        retriever = self.vector_store.as_retriever(
+            search_kwargs=search_kwargs,
+            search_type="mmr"  # Use MMR for better diversity
+        )
+
+        # Use ConversationalRetrievalChain - simplified approach without explicit memory
+        # The chain will handle conversation internally
+        return ConversationalRetrievalChain.from_llm(
+            llm=self.llm,
+            retriever=retriever,
+            combine_docs_chain_kwargs={"prompt": self._prompt},
+            return_source_documents=True,
+            verbose=True
+        )
+
+    def _get_qa_chain(self, filter_filename: Optional[str]) -> ConversationalRetrievalChain:
+        """Return the cached chain for a book filter, building it on first use.
+
+        Each filter gets its own retriever rather than mutating a shared one, so
+        concurrent queries for different books don't need to serialize. Only the
+        QA_CHAIN_CACHE_SIZE most recently used filters keep their chain.
+        """
+        key = filter_filename or None
+        with self._qa_chains_lock:
+            chain = self._qa_chains.get(key)
+            if chain is None:
+                # Building a chain is cheap (no I/O), so doing it under the lock is fine
+                chain = self._qa_chains[key] = self._build_qa_chain(key)
+                while len(self._qa_chains) > QA_CHAIN_CACHE_SIZE:
+                    self._qa_chains.popitem(last=False)
+            else:
+                self._qa_chains.move_to_end(key)
+        return chain
+
+    def document_count(self) -> int:
+        """Number of chunks in the vector store (cached instead of a COUNT per query).
+
+        The count lives in the shared cache and is invalidated whenever chunks are
+        written or removed, so every worker sees ingestions done by the others. It
+        also expires after DOC_COUNT_TTL in case a stale value slipped in.
+        """
+        cached = self.shared_cache.get(DOC_COUNT_KEY)
+        if cached is not None:
+            return int(cached)
+        collection = self.vector_store._collection
+        if not collection:
+            print("WARNING: Vector store collection is None")
+            return 0
+        count = collection.count()
+        self.shared_cache.set(DOC_COUNT_KEY, str(count).encode(), ttl=DOC_COUNT_TTL)
+        return count
+
+    def _encode_queries(self, texts: List[str]) -> List:
+        """Embed a batch of questions, reusing vectors from the on-disk cache."""
+        vectors = [self.embedding_store.get(text) for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            encoded = self._st_model.encode(
+                [texts[i] for i in missing],
+                batch_size=16,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+            for i, vector in zip(missing, encoded):
+                vectors[i] = vector
+                self.embedding_store.put(texts[i], vector)
+        return vectors
+
+    def warm_up(self):
+        """Run a dummy encode and search so the first real query doesn't pay cold-start costs."""
+        start = time.perf_counter()
+        # Call the model directly: embed_query may be answered from the embedding cache
+        self._st_model.encode(["warmup"], show_progress_bar=False)
+        encoded_at = time.perf_counter()
+        # Loads the HNSW index from disk
+        self.vector_store.similarity_search("warmup", k=1)
+        done_at = time.perf_counter()
+        print(f"Warm-up complete: model {(encoded_at - start) * 1000:.0f} ms, "
+              f"vector index {(done_at - encoded_at) * 1000:.0f} ms")
+
+    def clear_caches(self):
+        """Drop memoized embeddings, cached answers and the cached document count."""
+        self.embeddings.cache_clear()
+        self.answer_cache.clear()
+        self.shared_cache.delete(DOC_COUNT_KEY)
+
+    def _file_hash(self, file_path: str) -> str:
+        """SHA-256 of a file's bytes, read in blocks so large PDFs aren't loaded at once."""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _ingested_files_db(self) -> sqlite3.Connection:
+        # A fresh connection per call: ingestions are rare and this keeps the
+        # manifest safe to use from any thread or forked worker
+        conn = sqlite3.connect(os.path.join(self.persist_directory, INGESTED_FILES_DB), timeout=5.0)
+        # Keyed per source as well as content: an identical PDF under another name
+        # still needs its own chunks, or filtering /chat by that book finds nothing
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS ingested_sources "
+            "(file_hash TEXT, source TEXT, chunks INTEGER, ingested_at REAL, PRIMARY KEY (file_hash, source))"
+        )
+        return conn
+
+    def _is_ingested(self, file_hash: str, source: str) -> bool:
+        """Whether this content was completely ingested under this source name."""
+        with closing(self._ingested_files_db()) as conn:
+            row = conn.execute(
+                "SELECT 1 FROM ingested_sources WHERE file_hash = ? AND source = ?", (file_hash, source)
+            ).fetchone()
+        return row is not None
+
+    def _mark_ingested(self, file_hash: str, source: str, chunk_count: int):
+        """Record a completed ingestion; only written after the last batch is stored."""
+        with closing(self._ingested_files_db()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO ingested_sources (file_hash, source, chunks, ingested_at) VALUES (?, ?, ?, ?)",
+                (file_hash, source, chunk_count, time.time()),
+            )
+            conn.commit()
+
+    def _discard_partial_ingestion(self, file_hash: str, source: str):
+        """Remove chunks of an ingestion that never completed (failed or interrupted)."""
+        try:
+            self.vector_store._collection.delete(
+                where={"$and": [{"file_hash": file_hash}, {"source": source}]}
+            )
+        except Exception as e:
+            print(f"Error removing partially ingested chunks: {e}")
+        self.shared_cache.delete(DOC_COUNT_KEY)
+
+    def _discard_legacy_chunks(self, source: str):
+        """Remove chunks of this source stored before chunks were tagged with a file hash.
+
+        They would otherwise be duplicated by the first ingestion after upgrading.
+        """
+        stored = self.vector_store._collection.get(where={"source": source}, include=["metadatas"])
+        legacy = [
+            chunk_id for chunk_id, metadata in zip(stored["ids"], stored["metadatas"])
+            if not (metadata or {}).get("file_hash")
+        ]
+        if legacy:
+            print(f"Replacing {len(legacy)} chunks of {source} from an older ingestion")
+            self.vector_store._collection.delete(ids=legacy)
+            self.shared_cache.delete(DOC_COUNT_KEY)
+
+    def _iter_pages(self, file_path: str) -> Iterator[Document]:
+        """Yield PDF pages one at a time instead of loading the whole document."""
+        try:
+            yield from PyPDFLoader(file_path).lazy_load()
+        except Exception as e:
+            raise ValueError(f"Failed to load PDF: {str(e)}. The file might be corrupted or not a valid PDF.")
+
+    def _tag_chunk(self, chunk: Document, source: str, file_hash: str):
+        chunk.metadata["source"] = source
+        chunk.metadata["file_hash"] = file_hash
+        # Scoped to the source so text shared by two books is stored (and filterable) for each
+        chunk.metadata["chunk_hash"] = hashlib.sha256((source + "\0" + chunk.page_content).encode("utf-8")).hexdigest()
+
+    def _add_chunks(self, chunks: List[Document]) -> int:
+        """Embed a batch of chunks in one encode call and write them to the vector store.
+
+        Chunks are keyed by a hash of their source and text, so text repeated within
+        a book (or already stored by an earlier run) is skipped, while each book keeps
+        its own copy of text it shares with other books. Returns the number added.
+        """
+        try:
+            # Drop duplicates within the batch and chunks the store already has
+            unique = {chunk.metadata["chunk_hash"]: chunk for chunk in chunks}
+            existing = self.vector_store._collection.get(ids=list(unique), include=[])["ids"]
+            for chunk_id in existing:
+                unique.pop(chunk_id, None)
+            if not unique:
+                return 0
+
+            ids = list(unique)
+            new_chunks = list(unique.values())
+            texts = [chunk.page_content for chunk in new_chunks]
+            # Encode directly with the underlying model so the whole batch shares
+            # one tokenizer + forward pass, then write straight to the collection
+            vectors = self._st_model.encode(
+                texts,
+                batch_size=ENCODE_BATCH_SIZE,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+            self.vector_store._collection.add(
+                ids=ids,
+                embeddings=vectors.tolist(),
+                metadatas=[chunk.metadata for chunk in new_chunks],
+                documents=texts,
+            )
+            # Note: Chroma 0.4.x+ auto-persists, so persist() is no longer needed
+            # self.vector_store.persist()  # Deprecated in Chroma 0.4.x+
+            self.shared_cache.delete(DOC_COUNT_KEY)
+            # New content can change answers, so drop cached ones
+            self.answer_cache.clear()
+            return len(ids)
+        except Exception as e:
+            error_msg = str(e)
+            if "API key" in error_msg or "authentication" in error_msg.lower():
+                raise ValueError(f"Google API authentication failed: {error_msg}. Please check your GOOGLE_API_KEY.")
+            raise ValueError(f"Failed to add documents to vector store: {error_msg}")
+
     def ingest_file(self, file_path: str, collection_name: str = "default"):
         """Reads a PDF, chunks it, and saves vectors."""
         try:
-            print(f"Ingesting: {file_path}")
-            
-            # Check if file exists
-            if not os.path.exists(file_path):
-                raise FileNotFoundError(f"File not found: {file_path}")
-            
-            # Load PDF
-            try:
-                loader = PyPDFLoader(file_path)
-                documents = loader.load()
-            except Exception as e:
-                raise ValueError(f"Failed to load PDF: {str(e)}. The file might be corrupted or not a valid PDF.")
-            
-            if not documents or len(documents) == 0:
-                raise ValueError("PDF appears to be empty or could not be read.")
-            
-            # Split into chunks
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop in this thread (e.g. a background worker): run the pipeline
+            return asyncio.run(self.ingest_file_async(file_path, collection_name))
+        # Can't block on the pipeline from inside a running loop, use the serial path
+        return self._ingest_file_serial(file_path, collection_name)
+
+    def _begin_ingestion(self, file_path: str) -> Tuple[str, str, Optional[dict]]:
+        """Checks shared by both ingestion paths, run before any chunk is written.
+
+        Returns (file_hash, source, skipped); ``skipped`` is the result to return
+        as-is when the file doesn't need ingesting. Otherwise the caller holds the
+        file's ingestion claim and must release it with _release_ingestion().
+        """
+        print(f"Ingesting: {file_path}")
+
+        # Check if file exists
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"File not found: {file_path}")
+
+        # Check API key before trying to embed (embeddings are free, but we check for Groq key for LLM)
+        if not os.getenv("GROQ_API_KEY"):
+            raise ValueError("GROQ_API_KEY is not set. Please set it in your environment variables. Get your free key at: https://console.groq.com/")
+
+        source = os.path.basename(file_path)
+        # Skip files whose exact contents are already stored under this name
+        file_hash = self._file_hash(file_path)
+        if self._is_ingested(file_hash, source):
+            print(f"Already ingested (same content hash and name): {file_path}")
+            return file_hash, source, {"status": "already_ingested", "file_hash": file_hash}
+        # Only one ingestion of a file at a time (across workers too): a second one
+        # would delete the first one's chunks below
+        if not self.shared_cache.add(self._ingestion_claim_key(file_hash, source), b"1", ttl=INGEST_CLAIM_TTL):
+            print(f"Already being ingested: {file_path}")
+            return file_hash, source, {"status": "already_running", "file_hash": file_hash}
+        try:
+            # Chunks without a completion record are left over from an interrupted run
+            self._discard_partial_ingestion(file_hash, source)
+            self._discard_legacy_chunks(source)
+        except BaseException:
+            self._release_ingestion(file_hash, source)
+            raise
+        return file_hash, source, None
+
+    def _ingestion_claim_key(self, file_hash: str, source: str) -> str:
+        source_hash = hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+        return f"rag:ingesting:{file_hash}:{source_hash}"
+
+    def _release_ingestion(self, file_hash: str, source: str):
+        self.shared_cache.delete(self._ingestion_claim_key(file_hash, source))
+
+    async def ingest_file_async(self, file_path: str, collection_name: str = "default"):
+        """Pipelined ingestion: PDF pages -> chunks -> vector store, linked by bounded queues.
+
+        Page parsing, splitting and embedding/storing run concurrently so PDF I/O
+        overlaps with the embedding forward passes and Chroma writes. Blocking work
+        runs in threads, so this is safe to await from the event loop.
+        """
+        claimed = False
+        try:
+            file_hash, source, skipped = await asyncio.to_thread(self._begin_ingestion, file_path)
+            if skipped:
+                return skipped
+            claimed = True
+
             text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
-            chunks = text_splitter.split_documents(documents)
-            
-            if not chunks or len(chunks) == 0:
-                raise ValueError("No text chunks could be extracted from the PDF.")
+            # Bounded queues give backpressure so a fast reader can't outrun the embedder
+            pages: asyncio.Queue = asyncio.Queue(maxsize=PAGE_QUEUE_SIZE)
+            chunks: asyncio.Queue = asyncio.Queue(maxsize=CHUNK_QUEUE_SIZE)
+            end = object()
+            counts = {"pages": 0, "chunks": 0, "added": 0}
 
-            # Add metadata
-            for chunk in chunks:
-                chunk.metadata["source"] = os.path.basename(file_path)
+            async def read_pages():
+                page_iter = self._iter_pages(file_path)
+                while (page := await asyncio.to_thread(next, page_iter, None)) is not None:
+                    counts["pages"] += 1
+                    await pages.put(page)
+                await pages.put(end)
 
-            # Check API key before trying to embed (embeddings are free, but we check for Groq key for LLM)
-            if not os.getenv("GROQ_API_KEY"):
-                raise ValueError("GROQ_API_KEY is not set. Please set it in your environment variables. Get your free key at: https://console.groq.com/")
-            
-            # Add to vector store
+            async def split_pages():
+                while (page := await pages.get()) is not end:
+                    for chunk in await asyncio.to_thread(text_splitter.split_documents, [page]):
+                        self._tag_chunk(chunk, source, file_hash)
+                        await chunks.put(chunk)
+                await chunks.put(end)
+
+            async def store_chunks():
+                batch = []
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is not end:
+                        batch.append(chunk)
+                    if batch and (chunk is end or len(batch) >= INGEST_BATCH_SIZE):
+                        counts["added"] += await asyncio.to_thread(self._add_chunks, batch)
+                        counts["chunks"] += len(batch)
+                        batch = []
+                    if chunk is end:
+                        return
+
+            tasks = [asyncio.create_task(stage()) for stage in (read_pages, split_pages, store_chunks)]
             try:
-                self.vector_store.add_documents(chunks)
-                # Note: Chroma 0.4.x+ auto-persists, so persist() is no longer needed
-                # self.vector_store.persist()  # Deprecated in Chroma 0.4.x+
-            except Exception as e:
-                error_msg = str(e)
-                if "API key" in error_msg or "authentication" in error_msg.lower():
-                    raise ValueError(f"Google API authentication failed: {error_msg}. Please check your GOOGLE_API_KEY.")
-                raise ValueError(f"Failed to add documents to vector store: {error_msg}")
+                # Fail fast: a dead stage would otherwise leave its neighbours blocked on a queue
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    task.result()
+            except BaseException:
+                await asyncio.to_thread(self._discard_partial_ingestion, file_hash, source)
+                raise
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            if counts["pages"] == 0:
+                raise ValueError("PDF appears to be empty or could not be read.")
+            if counts["chunks"] == 0:
+                raise ValueError("No text chunks could be extracted from the PDF.")
+            await asyncio.to_thread(self._mark_ingested, file_hash, source, counts["chunks"])
             
-            print(f"Successfully ingested {len(chunks)} chunks from {file_path}")
+            print(f"Successfully ingested {counts['chunks']} chunks ({counts['added']} new) from {file_path}")
+            return {"status": "ingested", "file_hash": file_hash, "chunks": counts["chunks"], "added": counts["added"]}
         except Exception as e:
             print(f"Error during ingestion: {str(e)}")
             raise
+        finally:
+            if claimed:
+                await asyncio.to_thread(self._release_ingestion, file_hash, source)
 
-    def query(self, question: str, filter_filename: str = None, chat_history: Optional[List] = None) -> Tuple[str, List[str]]:
-        """Query the RAG system with conversational context and return both answer and source documents."""
+    def _ingest_file_serial(self, file_path: str, collection_name: str = "default"):
+        """Single-threaded ingestion used when an event loop is already running.
+
+        Pages are still streamed and written in batches, so memory stays bounded
+        by the batch size rather than the size of the book.
+        """
+        claimed = False
         try:
-            search_kwargs = {"k": 8}  # Retrieve more documents for better context
-            if filter_filename:
-                search_kwargs["filter"] = {"source": filter_filename}
+            file_hash, source, skipped = self._begin_ingestion(file_path)
+            if skipped:
+                return skipped
+            claimed = True
 
-            # Check if store has documents
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
+            page_count = chunk_count = added = 0
+            batch = []
             try:
-                collection = self.vector_store._collection
-                if collection:
-                    count = collection.count()
-                    print(f"Vector store has {count} documents")
-                    if count == 0:
-                        return (
-                            "I don't have any books in my memory yet. Please ingest a book first by clicking 'Memorize Book' on a selected PDF.",
-                            []
-                        )
-                else:
-                    print("WARNING: Vector store collection is None")
-                    return (
-                        "I don't have any books in my memory yet. Please ingest a book first by clicking 'Memorize Book' on a selected PDF.",
-                        []
-                    )
-            except Exception as e:
-                print(f"Error checking document count: {e}")
-                # Proceed anyway - might still work
-            
-            retriever = self.vector_store.as_retriever(
-                search_kwargs=search_kwargs,
-                search_type="mmr",  # Use MMR for better diversity
-                search_type_kwargs={"k": 8, "fetch_k": 20}
-            )
+                for page in self._iter_pages(file_path):
+                    page_count += 1
+                    for chunk in text_splitter.split_documents([page]):
+                        self._tag_chunk(chunk, source, file_hash)
+                        batch.append(chunk)
+                    if len(batch) >= INGEST_BATCH_SIZE:
+                        added += self._add_chunks(batch)
+                        chunk_count += len(batch)
+                        batch = []
+                if batch:
+                    added += self._add_chunks(batch)
+                    chunk_count += len(batch)
+            except Exception:
+                self._discard_partial_ingestion(file_hash, source)
+                raise
+
+            if page_count == 0:
+                raise ValueError("PDF appears to be empty or could not be read.")
+            if chunk_count == 0:
+                raise ValueError("No text chunks could be extracted from the PDF.")
+            self._mark_ingested(file_hash, source, chunk_count)
             
-            # Create a better prompt template for study assistance
-            # ConversationalRetrievalChain will provide chat_history as a variable
-            system_prompt = """You are an intelligent study assistant helping a student understand their course materials. 
-Your role is to:
-1. Understand the context of questions even if they're phrased informally (e.g., "this chapter", "this pdf", "summarize this")
-2. Provide comprehensive, helpful answers based on the retrieved documents
-3. Connect concepts and provide explanations, not just quote text
-4. If the question is vague, infer context from the conversation history and retrieved documents
-5. When asked to summarize, provide a clear, structured summary of the key points
+            print(f"Successfully ingested {chunk_count} chunks ({added} new) from {file_path}")
+            return {"status": "ingested", "file_hash": file_hash, "chunks": chunk_count, "added": added}
+        except Exception as e:
+            print(f"Error during ingestion: {str(e)}")
+            raise
+        finally:
+            if claimed:
+                self._release_ingestion(file_hash, source)
 
-Use the following pieces of retrieved context to answer the question. If you don't know the answer based on the context, say so, but try to be helpful.
+    def _empty_store_reply(self) -> Optional[Tuple[str, List[str]]]:
+        """Reply to send instead of querying when no books have been ingested yet."""
+        # Check if store has documents
+        try:
+            count = self.document_count()
+            print(f"Vector store has {count} documents")
+            if count == 0:
+                return (
+                    "I don't have any books in my memory yet. Please ingest a book first by clicking 'Memorize Book' on a selected PDF.",
+                    []
+                )
+        except Exception as e:
+            print(f"Error checking document count: {e}")
+            # Proceed anyway - might still work
+        return None
 
-Context from the documents:
-{context}
+    def _chain_input(self, question: str, chat_history: Optional[List]) -> dict:
+        # ConversationalRetrievalChain expects chat_history as a list of tuples (human_msg, ai_msg)
+        invoke_input = {"question": question}
+        if chat_history:
+            invoke_input["chat_history"] = []
+            # Format chat history as list of tuples
+            for i in range(0, len(chat_history) - 1, 2):
+                if i + 1 < len(chat_history):
+                    user_msg = chat_history[i].get("content", "") if chat_history[i].get("role") == "user" else ""
+                    ai_msg = chat_history[i + 1].get("content", "") if chat_history[i + 1].get("role") == "ai" else ""
+                    if user_msg and ai_msg:
+                        invoke_input["chat_history"].append((user_msg, ai_msg))
+        else:
+            invoke_input["chat_history"] = []
+        return invoke_input
 
-Previous conversation:
-{chat_history}
+    def _needs_rewrite(self, question: str, chain_input: dict) -> bool:
+        """Whether a follow-up must be rewritten into a standalone question before retrieval.
 
-Question: {question}
+        First questions need no rewrite, and neither do longer follow-ups that
+        don't open with a pronoun referring back to the conversation.
+        """
+        if not chain_input["chat_history"]:
+            return False
+        words = question.lower().split()
+        if len(words) < STANDALONE_MIN_WORDS:
+            return True
+        return words[0].strip(",.?!:;'\"") in FOLLOW_UP_PRONOUNS
 
-Provide a helpful, comprehensive answer:"""
-            
-            prompt = PromptTemplate(
-                template=system_prompt,
-                input_variables=["context", "question", "chat_history"]
+    def _parse_result(self, result) -> Tuple[str, List[str]]:
+        """Extract the answer and de-duplicated source names from a chain result."""
+        print(f"RAG query completed. Result type: {type(result)}")
+        
+        # Extract answer
+        answer = result.get("answer", "") if isinstance(result, dict) else str(result)
+        if not answer:
+            print("WARNING: Empty answer from RAG chain")
+            answer = "I couldn't generate a response. Please try rephrasing your question."
+        
+        # Extract sources from source documents (de-duplicated, first-seen order)
+        source_documents = result.get("source_documents", []) if isinstance(result, dict) else []
+        sources = list(dict.fromkeys(doc.metadata.get("source", "Unknown") for doc in source_documents))
+        return answer, sources
+
+    def _record_llm_calls(self, count: int):
+        now = time.monotonic()
+        with self._llm_call_times_lock:
+            self._llm_call_times.extend([now] * count)
+
+    def llm_quota_remaining(self) -> int:
+        """Groq requests still available in the current one-minute window (client-side estimate)."""
+        cutoff = time.monotonic() - 60
+        with self._llm_call_times_lock:
+            while self._llm_call_times and self._llm_call_times[0] < cutoff:
+                self._llm_call_times.popleft()
+            return max(GROQ_REQUESTS_PER_MINUTE - len(self._llm_call_times), 0)
+
+    def _call_llm(self, call, llm_calls: int = 1):
+        """Run a step that calls Groq, retrying with backoff on rate-limit and transient errors."""
+        for attempt in Retrying(**GROQ_RETRY_POLICY):
+            with attempt:
+                self._record_llm_calls(llm_calls)
+                return call()
+
+    async def _acall_llm(self, call, llm_calls: int = 1):
+        """Async version of _call_llm() that also waits for the client-side rate limiter."""
+        async for attempt in AsyncRetrying(**GROQ_RETRY_POLICY):
+            with attempt:
+                await self.llm_limiter.acquire(llm_calls)
+                self._record_llm_calls(llm_calls)
+                return await call()
+
+    def _error_reply(self, e: Exception) -> Tuple[str, List[str]]:
+        error_msg = str(e)
+        print(f"RAG query error: {error_msg}")
+        
+        # Provide helpful error messages
+        if isinstance(e, RateLimitError):
+            return (
+                "The AI service is receiving too many requests right now (Groq rate limit). Please wait a moment and try again.",
+                []
             )
-            
-            # Use ConversationalRetrievalChain - simplified approach without explicit memory
-            # The chain will handle conversation internally
-            qa_chain = ConversationalRetrievalChain.from_llm(
-                llm=self.llm,
-                retriever=retriever,
-                combine_docs_chain_kwargs={"prompt": prompt},
-                return_source_documents=True,
-                verbose=True
+        elif "GROQ_API_KEY" in error_msg or "API key" in error_msg.lower() or "groq" in error_msg.lower():
+            return (
+                "Error: Groq API key is missing or invalid. Please check your GROQ_API_KEY environment variable. Get your free key at: https://console.groq.com/",
+                []
+            )
+        elif "empty" in error_msg.lower() or "no documents" in error_msg.lower():
+            return (
+                "I don't have any books in my memory yet. Please ingest a book first by clicking 'Memorize Book'.",
+                []
             )
+        else:
+            return (
+                f"I encountered an error while processing your question: {error_msg}. Please try again or check the backend logs.",
+                []
+            )
+
+    def query(self, question: str, filter_filename: str = None, chat_history: Optional[List] = None) -> Tuple[str, List[str]]:
+        """Query the RAG system with conversational context and return both answer and source documents."""
+        try:
+            empty_reply = self._empty_store_reply()
+            if empty_reply:
+                return empty_reply
+
+            # Semantic cache lookup. Follow-ups depend on the conversation, so only
+            # standalone questions are served from / stored in the cache.
+            question_vector = None
+            if not chat_history:
+                question_vector = self.embeddings.embed_query(question)
+                cached = self.answer_cache.lookup(question_vector, filter_key=filter_filename)
+                if cached is not None:
+                    print(f"Semantic cache hit for question: {question[:50]}...")
+                    return cached
 
+            qa_chain = self._get_qa_chain(filter_filename)
+            chain_input = self._chain_input(question, chat_history)
             print(f"Querying RAG with question: {question[:50]}...")
-            # ConversationalRetrievalChain expects chat_history as a list of tuples (human_msg, ai_msg)
-            invoke_input = {"question": question}
-            if chat_history:
-                invoke_input["chat_history"] = []
-                # Format chat history as list of tuples
-                for i in range(0, len(chat_history) - 1, 2):
-                    if i + 1 < len(chat_history):
-                        user_msg = chat_history[i].get("content", "") if chat_history[i].get("role") == "user" else ""
-                        ai_msg = chat_history[i + 1].get("content", "") if chat_history[i + 1].get("role") == "ai" else ""
-                        if user_msg and ai_msg:
-                            invoke_input["chat_history"].append((user_msg, ai_msg))
+            if self._needs_rewrite(question, chain_input):
+                # Two Groq calls: question rewrite + answer
+                result = self._call_llm(lambda: qa_chain.invoke(chain_input), llm_calls=2)
             else:
-                invoke_input["chat_history"] = []
-            
-            result = qa_chain.invoke(invoke_input)
-            print(f"RAG query completed. Result type: {type(result)}")
-            
-            # Extract answer
-            answer = result.get("answer", "") if isinstance(result, dict) else str(result)
-            if not answer:
-                print("WARNING: Empty answer from RAG chain")
-                answer = "I couldn't generate a response. Please try rephrasing your question."
-            
-            # Extract sources from source documents
-            sources = []
-            if isinstance(result, dict) and "source_documents" in result:
-                seen_sources = set()
-                for doc in result["source_documents"]:
-                    source = doc.metadata.get("source", "Unknown")
-                    if source not in seen_sources:
-                        sources.append(source)
-                        seen_sources.add(source)
+                # Retrieve on the raw question, skipping the extra LLM call that
+                # rewrites it into a standalone question
+                docs = qa_chain.retriever.invoke(question)
+                result = self._call_llm(lambda: self._answer_from_docs(qa_chain, question, docs, chain_input))
+            answer, sources = self._parse_result(result)
             
+            if question_vector is not None and isinstance(result, dict) and result.get("answer"):
+                self.answer_cache.add(question_vector, answer, sources, filter_key=filter_filename)
+
             print(f"Returning answer (length: {len(answer)}), sources: {sources}")
             return answer, sources
         except Exception as e:
-            error_msg = str(e)
-            print(f"RAG query error: {error_msg}")
-            
-            # Provide helpful error messages
-            if "GROQ_API_KEY" in error_msg or "API key" in error_msg.lower() or "groq" in error_msg.lower():
-                return (
-                    "Error: Groq API key is missing or invalid. Please check your GROQ_API_KEY environment variable. Get your free key at: https://console.groq.com/",
-                    []
-                )
-            elif "empty" in error_msg.lower() or "no documents" in error_msg.lower():
-                return (
-                    "I don't have any books in my memory yet. Please ingest a book first by clicking 'Memorize Book'.",
-                    []
-                )
+            return self._error_reply(e)
+
+    def _retrieve_uncached(self, text: str, filter_filename: Optional[str]) -> List[Document]:
+        """Same MMR search as the QA chain retriever, embedding ``text`` with the model directly.
+
+        Used for partially typed questions, which would otherwise fill the query
+        embedding LRU and the persistent embedding store with text never asked.
+        """
+        vector = self._st_model.encode(
+            [text], convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+        )[0]
+        return self.vector_store.max_marginal_relevance_search_by_vector(
+            vector.tolist(),
+            filter={"source": filter_filename} if filter_filename else None,
+            **RETRIEVER_SEARCH_KWARGS,
+        )
+
+    async def aprefetch(self, partial_question: str, session_id: str, filter_filename: str = None) -> int:
+        """Retrieve documents for a partially typed question and stash them for aquery().
+
+        Returns the number of documents prefetched.
+        """
+        if not partial_question.strip() or not await asyncio.to_thread(self.document_count):
+            return 0
+        docs = await asyncio.to_thread(self._retrieve_uncached, partial_question, filter_filename)
+        self.prefetch_cache.put(session_id, partial_question, docs, filter_key=filter_filename)
+        return len(docs)
+
+    def _combine_inputs(self, qa_chain: ConversationalRetrievalChain, question: str, docs: List[Document], chain_input: dict) -> dict:
+        get_chat_history = qa_chain.get_chat_history or _get_chat_history
+        return {
+            "input_documents": docs,
+            "question": question,
+            "chat_history": get_chat_history(chain_input["chat_history"]),
+        }
+
+    def _answer_from_docs(self, qa_chain: ConversationalRetrievalChain, question: str, docs: List[Document], chain_input: dict) -> dict:
+        """Run only the answer-generation step of the chain on already retrieved documents."""
+        combine_chain = qa_chain.combine_docs_chain
+        output = combine_chain.invoke(self._combine_inputs(qa_chain, question, docs, chain_input))
+        return {"answer": output[combine_chain.output_key], "source_documents": docs}
+
+    async def _aanswer_from_docs(self, qa_chain: ConversationalRetrievalChain, question: str, docs: List[Document], chain_input: dict) -> dict:
+        """Async version of _answer_from_docs()."""
+        combine_chain = qa_chain.combine_docs_chain
+        output = await combine_chain.ainvoke(self._combine_inputs(qa_chain, question, docs, chain_input))
+        return {"answer": output[combine_chain.output_key], "source_documents": docs}
+
+    async def aquery(self, question: str, filter_filename: str = None, chat_history: Optional[List] = None, session_id: Optional[str] = None) -> Tuple[str, List[str]]:
+        """Async version of query(): the LLM call is awaited instead of holding a worker thread."""
+        try:
+            empty_reply = await asyncio.to_thread(self._empty_store_reply)
+            if empty_reply:
+                return empty_reply
+
+            # Semantic cache lookup (standalone questions only, see query())
+            question_vector = None
+            if not chat_history:
+                question_vector = await self.query_batcher.embed(question)
+                # The cache may sync from Redis, so keep it off the event loop
+                cached = await asyncio.to_thread(self.answer_cache.lookup, question_vector, filter_key=filter_filename)
+                if cached is not None:
+                    print(f"Semantic cache hit for question: {question[:50]}...")
+                    return cached
+
+            qa_chain = self._get_qa_chain(filter_filename)
+            chain_input = self._chain_input(question, chat_history)
+            print(f"Querying RAG with question: {question[:50]}...")
+            if self._needs_rewrite(question, chain_input):
+                # Two Groq calls: question rewrite + answer
+                result = await self._acall_llm(lambda: qa_chain.ainvoke(chain_input), llm_calls=2)
             else:
-                return (
-                    f"I encountered an error while processing your question: {error_msg}. Please try again or check the backend logs.",
-                    []
-                )
+                # Retrieval runs on the raw question, so documents prefetched
+                # while the user was typing can be reused
+                docs = None
+                if session_id:
+                    docs = self.prefetch_cache.match(session_id, question, filter_key=filter_filename)
+                if docs is not None:
+                    print(f"Using {len(docs)} prefetched documents")
+                else:
+                    docs = await qa_chain.retriever.ainvoke(question)
+                result = await self._acall_llm(lambda: self._aanswer_from_docs(qa_chain, question, docs, chain_input))
+            answer, sources = self._parse_result(result)
+
+            if question_vector is not None and isinstance(result, dict) and result.get("answer"):
+                await asyncio.to_thread(self.answer_cache.add, question_vector, answer, sources, filter_key=filter_filename)
+
+            print(f"Returning answer (length: {len(answer)}), sources: {sources}")
+            return answer, sources
+        except Exception as e:
+            return self._error_reply(e)
+
+_rag_engine: Optional[RAGEngine] = None
+_rag_engine_lock = threading.Lock()
 
-rag_engine = RAGEngine()
+def get_rag_engine() -> RAGEngine:
+    """Process-wide RAGEngine, created on first use so importing this module stays cheap."""
+    global _rag_engine
+    if _rag_engine is None:
+        with _rag_engine_lock:
+            if _rag_engine is None:
+                _rag_engine = RAGEngine()
+    return _rag_engine
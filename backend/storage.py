@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 from typing import List, Optional
 import os
-import glob
+import time
 
 class StorageProvider(ABC):
     @abstractmethod
@@ -15,14 +15,44 @@ class StorageProvider(ABC):
         pass
 
 class LocalStorageProvider(StorageProvider):
-    def __init__(self, base_dir: str = "library"):
+    def __init__(self, base_dir: str = "library", cache_ttl: float = 30.0):
         self.base_dir = os.path.abspath(base_dir)
+        # Listings rarely change between clicks, so reuse them for a short while
+        self.cache_ttl = cache_ttl
+        self._cached_files: Optional[List[str]] = None
+        self._cached_at = 0.0
 
     def list_files(self) -> List[str]:
-        # Recursive glob to find all PDFs
-        files = glob.glob(os.path.join(self.base_dir, "**/*.pdf"), recursive=True)
-        # Return relative paths for cleaner APIs
-        return [os.path.relpath(f, self.base_dir) for f in files]
+        now = time.monotonic()
+        if self._cached_files is not None and now - self._cached_at < self.cache_ttl:
+            return list(self._cached_files)
+        files = self._scan_pdfs()
+        self._cached_files, self._cached_at = files, now
+        return list(files)
+
+    def _scan_pdfs(self) -> List[str]:
+        # Iterative scandir walk: entry types come from the directory listing
+        # itself, so there's no extra stat() per file as with a recursive glob
+        results = []
+        stack = [self.base_dir]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        # Skip hidden files and folders, like glob does
+                        if entry.name.startswith("."):
+                            continue
+                        # Don't follow directory symlinks: a link back up the tree would loop
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.lower().endswith(".pdf") and entry.is_file():
+                            # Return relative paths for cleaner APIs
+                            results.append(os.path.relpath(entry.path, self.base_dir))
+            except OSError:
+                # Unreadable folder (permissions, removed mid-scan): skip it
+                continue
+        return results
 
     def get_file_path(self, filename: str) -> str:
         # Securely join paths to prevent directory traversal
@@ -1,6 +1,6 @@
 "use client";
 
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import dynamic from "next/dynamic";
 import { FileBrowser } from "@/components/file-browser";
 import { Send, Moon, Sun, Menu, X } from "lucide-react";
@@ -25,6 +25,7 @@ export default function Home() {
   const [darkMode, setDarkMode] = useState(false);
   const [isLibraryOpen, setIsLibraryOpen] = useState(true);
   const [ingestedBooks, setIngestedBooks] = useState<Set<string>>(new Set());
+  const sessionIdRef = useRef<string>("");
 
   // Load preferences from localStorage on mount
   useEffect(() => {
@@ -42,6 +43,30 @@ export default function Home() {
     }
   }, []);
 
+  // Identify this client so the backend can match prefetches to chat requests
+  useEffect(() => {
+    sessionIdRef.current = crypto.randomUUID();
+  }, []);
+
+  // Prefetch retrieval while the user is still typing
+  useEffect(() => {
+    if (query.trim().length < 10) return;
+    const timer = setTimeout(() => {
+      fetch("http://localhost:8000/chat/prefetch", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+          partial_message: query,
+          session_id: sessionIdRef.current,
+          book_context: selectedBook?.split('/').pop()
+        }),
+      }).catch(() => {
+        // Best-effort: the chat request retrieves normally on a miss
+      });
+    }, 300);
+    return () => clearTimeout(timer);
+  }, [query, selectedBook]);
+
   // Toggle dark mode
   function toggleDarkMode() {
     const newDarkMode = !darkMode;
@@ -64,6 +89,31 @@ export default function Home() {
     localStorage.setItem('library-open', newState.toString());
   }
 
+  // Queue ingestion of a book and poll the backend job until it finishes
+  async function ingestAndWait(bookPath: string) {
+    const encodedFilename = encodeURIComponent(bookPath);
+    const response = await fetch(`http://localhost:8000/ingest?filename=${encodedFilename}`, { 
+      method: 'POST' 
+    });
+    
+    if (!response.ok) {
+      const errorData = await response.json().catch(() => ({ detail: response.statusText }));
+      throw new Error(errorData.detail || `Server error: ${response.status}`);
+    }
+    
+    const { job_id } = await response.json();
+    while (true) {
+      await new Promise(resolve => setTimeout(resolve, 1000));
+      const statusRes = await fetch(`http://localhost:8000/ingest/${job_id}`);
+      if (!statusRes.ok) {
+        throw new Error(`Server error: ${statusRes.status}`);
+      }
+      const job = await statusRes.json();
+      if (job.state === 'done') return job;
+      if (job.state === 'error') throw new Error(job.error || 'Ingestion failed');
+    }
+  }
+
   // Auto-ingest book when selected
   async function autoIngestBook(bookPath: string) {
     // Skip if already ingested
@@ -72,17 +122,9 @@ export default function Home() {
     }
 
     try {
-      const encodedFilename = encodeURIComponent(bookPath);
-      const response = await fetch(`http://localhost:8000/ingest?filename=${encodedFilename}`, { 
-        method: 'POST' 
-      });
-      
-      if (response.ok) {
-        setIngestedBooks(prev => new Set(prev).add(bookPath));
-        console.log(`Auto-ingested: ${bookPath}`);
-      } else {
-        console.warn(`Failed to auto-ingest ${bookPath}, but continuing...`);
-      }
+      await ingestAndWait(bookPath);
+      setIngestedBooks(prev => new Set(prev).add(bookPath));
+      console.log(`Auto-ingested: ${bookPath}`);
     } catch (error) {
       // Silently fail for auto-ingestion - user can manually ingest if needed
       console.warn(`Auto-ingestion error for ${bookPath}:`, error);
@@ -128,7 +170,8 @@ export default function Home() {
         body: JSON.stringify({ 
           message: userMessage, 
           book_context: selectedBook?.split('/').pop(),
-          chat_history: recentHistory
+          chat_history: recentHistory,
+          session_id: sessionIdRef.current
         }),
       });
       
@@ -157,19 +200,9 @@ export default function Home() {
     if (!selectedBook) return;
     setIsIngesting(true);
     try {
-      const encodedFilename = encodeURIComponent(selectedBook);
-      const response = await fetch(`http://localhost:8000/ingest?filename=${encodedFilename}`, { 
-        method: 'POST' 
-      });
-      
-      if (!response.ok) {
-        const errorData = await response.json().catch(() => ({ detail: response.statusText }));
-        throw new Error(errorData.detail || `Server error: ${response.status}`);
-      }
-      
-      const data = await response.json();
+      await ingestAndWait(selectedBook);
       setIngestedBooks(prev => new Set(prev).add(selectedBook));
-      alert(`Success! ${data.message || 'Book ingrained in memory!'}`);
+      alert(`Success! Book ingrained in memory!`);
     } catch (e: any) {
       const errorMsg = e.message || "Failed to ingest book. Check backend logs.";
       alert(`Error: ${errorMsg}`);